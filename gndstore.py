@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Storage helpers shared by the pipeline (gndzero.py) and the cache server
+(server.py): artefact locations, sqlite3 access and record conversion.
+
+Keep this module cheap to import. No luigi, pandas or other pipeline
+dependencies here, config.py is optional and lxml is only loaded when a
+record actually gets converted.
+"""
+
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+
+try:
+    import config
+except ImportError:
+    config = None
+
+
+def setting(name, default=None):
+    """
+    Return a setting from the environment (as GNDZERO_<name>) or from
+    config.py, in that order.
+    """
+    return os.environ.get('GNDZERO_%s' % name) or getattr(config, name, default)
+
+
+TAG = 'gndzero'
+HOME = setting('HOME', './data')
+TEMPDIR = setting('TEMPDIR', '/tmp')
+
+# the dump, the artefacts are named after, see GNDTask.latest
+LATEST = datetime.date(2013, 11, 8)
+
+
+def convert(name):
+    """
+    Convert CamelCase to underscore, http://stackoverflow.com/a/1176023/89391.
+    """
+    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1-\2', name)
+    return re.sub('([a-z0-9])([A-Z])', r'\1-\2', s1).lower()
+
+
+def split(iterable, n):
+    """
+    Generalized `pairwise`. Split an iterable after every `n` items.
+    """
+    i = iter(iterable)
+    piece = tuple(itertools.islice(i, n))
+    while piece:
+        yield piece
+        piece = tuple(itertools.islice(i, n))
+
+
+def top(path, k, column=1):
+    """
+    Return the `k` rows of a tab separated file with the largest (float)
+    values in `column`, largest first. The file is streamed, only `k` rows
+    are kept in memory.
+    """
+    with open(path) as handle:
+        rows = (line.rstrip('\n').split('\t') for line in handle)
+        return heapq.nlargest(k, rows, key=lambda row: float(row[column]))
+
+
+def ranked(path, n):
+    """
+    Return the ids of the `n` highest ranked records from a ranking, that
+    is a TSV with id and PageRank in the first two columns, like the
+    outputs of TranslatePageRank and HumanReadablePageRank.
+    """
+    return [row[0] for row in top(path, n)]
+
+
+def requested(path, n):
+    """
+    Return the ids of the `n` most requested records from an access log.
+    """
+    pattern = re.compile(r'/(?:cache|gnd)/([0-9X-]+)')
+    counter = collections.Counter()
+    with open(path) as handle:
+        for line in handle:
+            match = pattern.search(line)
+            if match:
+                counter[match.group(1)] += 1
+    return [id for id, _ in counter.most_common(n)]
+
+
+def artifact(task, ext='db', filename=None):
+    """
+    Return the path, where gndzero.py puts the output of `task` (a class
+    name, e.g. SqliteDB).
+    """
+    if filename is None:
+        filename = '{date}.{ext}'.format(date=LATEST, ext=ext)
+    return os.path.join(HOME, TAG, convert(task), filename)
+
+
+def newest(task, ext='db'):
+    """
+    Return the most recent completed output of `task` or None. Outputs are
+    named after the date of their dump, so the most recent one is the last
+    by name. Since luigi moves outputs into place only when they are done,
+    every file found is complete; partial outputs of sharded runs are skipped.
+    """
+    directory = os.path.dirname(artifact(task, ext=ext))
+    if not os.path.isdir(directory):
+        return None
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith('.' + ext) and '-of-' not in name]
+    if not paths:
+        return None
+    return max(paths)
+
+
+def resolve(name, task, ext='db'):
+    """
+    Return the path to use for `name`: the setting `name`, if given,
+    otherwise the newest output of pipeline task `task`.
+    """
+    return setting(name) or newest(task, ext=ext) or artifact(task, ext=ext)
+
+
+class dbopen(object):
+    """
+    Simple context manager for sqlite3 databases. Commits everything at exit.
+
+        with dbopen('/tmp/test.db') as cursor:
+            query = cursor.execute('SELECT * FROM items')
+            result = query.fetchall()
+            ...
+
+    With `readonly`, the database is opened read-only and must exist; it is
+    never created or written to.
+    """
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.conn = None
+        self.cursor = None
+
+    def __enter__(self):
+        if self.readonly:
+            self.conn = self.connect_readonly()
+        else:
+            self.conn = sqlite3.connect(self.path)
+        self.conn.text_factory = str
+        self.cursor = self.conn.cursor()
+        return self.cursor
+
+    def connect_readonly(self):
+        """
+        Open the database with mode=ro (python 3.4+). Python 2 cannot pass
+        URIs, so the connection refuses writes (query_only) instead.
+        """
+        path = re.sub(r'[%?#]', lambda m: '%%%02x' % ord(m.group()),
+                      self.path)
+        try:
+            return sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+        except TypeError:
+            pass
+        if not os.path.exists(self.path):
+            # like mode=ro, do not create the database
+            raise sqlite3.OperationalError('unable to open database file')
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def __exit__(self, exc_class, exc, traceback):
+        self.conn.commit()
+        self.conn.close()
+
+
+class LRUCache(object):
+    """
+    A thread safe cache, which evicts the least recently used entries once
+    the total length of the values exceeds `maxbytes`.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.maxbytes:
+            return
+        with self.lock:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.maxbytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def full(self):
+        return self.size >= self.maxbytes
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+#
+# RDF/XML records to JSON-LD and N-Triples
+#
+NAMESPACES = {
+    'gnd': 'http://d-nb.info/standards/elementset/gnd#',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'rda': 'http://rdvocab.info/',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'isbd': 'http://iflastandards.info/ns/isbd/elements/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'marcRole': 'http://id.loc.gov/vocabulary/relators/',
+    'lib': 'http://purl.org/library/',
+    'umbel': 'http://umbel.org/umbel#',
+    'bibo': 'http://purl.org/ontology/bibo/',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+}
+
+RDF = NAMESPACES['rdf']
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+class ConversionError(ValueError):
+    """ Raised, if a record is not valid RDF/XML. """
+
+
+def unwrap(document):
+    """
+    Return the inside of the rdf:RDF element of a full RDF/XML document (as
+    served by d-nb.info), which is how records are stored in SqliteDB.
+    """
+    match = re.search(r'<rdf:RDF[^>]*>(.*)</rdf:RDF>', document, re.S)
+    if match:
+        return match.group(1).strip()
+    return document
+
+
+def triples(content):
+    """
+    Parse a record (an RDF/XML snippet without namespace declarations, as
+    stored in SqliteDB, or a full RDF/XML document) into a list of (subject,
+    predicate, object) triples. Subjects and objects are ('uri', value),
+    ('bnode', label) or ('literal', value, language, datatype). Raises
+    ConversionError for invalid XML.
+    """
+    from lxml import etree
+
+    declarations = ' '.join('xmlns:%s="%s"' % item
+                            for item in sorted(NAMESPACES.items()))
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    if not re.match(br'\s*<(\?xml|rdf:RDF)', content):
+        content = (b'<rdf:RDF ' + declarations.encode('ascii') + b'>' +
+                   content + b'</rdf:RDF>')
+    try:
+        root = etree.fromstring(content)
+    except etree.XMLSyntaxError as err:
+        raise ConversionError(str(err))
+    result, bnodes = [], itertools.count()
+
+    def name(tag):
+        return ''.join(tag[1:].split('}', 1))
+
+    def node(element):
+        about = element.get('{%s}about' % RDF)
+        if about is not None:
+            subject = ('uri', about)
+        else:
+            subject = ('bnode', element.get('{%s}nodeID' % RDF) or
+                                'b%d' % next(bnodes))
+        if element.tag != '{%s}Description' % RDF:
+            result.append((subject, ('uri', RDF + 'type'),
+                           ('uri', name(element.tag))))
+        properties(subject, element)
+        return subject
+
+    def properties(subject, element):
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            predicate = ('uri', name(child.tag))
+            resource = child.get('{%s}resource' % RDF)
+            if resource is not None:
+                result.append((subject, predicate, ('uri', resource)))
+            elif child.get('{%s}parseType' % RDF) == 'Resource':
+                blank = ('bnode', 'b%d' % next(bnodes))
+                result.append((subject, predicate, blank))
+                properties(blank, child)
+            elif len(child):
+                for grandchild in child:
+                    if isinstance(grandchild.tag, str):
+                        result.append((subject, predicate, node(grandchild)))
+            else:
+                result.append((subject, predicate,
+                               ('literal', child.text or '',
+                                child.get(XML_LANG),
+                                child.get('{%s}datatype' % RDF))))
+
+    for element in root:
+        if isinstance(element.tag, str):
+            node(element)
+    return result
+
+
+def ntriples(content):
+    """ Serialize a record as N-Triples (UTF-8). """
+    def term(value):
+        if value[0] == 'uri':
+            return u'<%s>' % value[1]
+        if value[0] == 'bnode':
+            return u'_:%s' % value[1]
+        literal = u'"%s"' % (value[1].replace('\\', '\\\\')
+                                     .replace('"', '\\"')
+                                     .replace('\n', '\\n')
+                                     .replace('\r', '\\r'))
+        if value[2]:
+            return literal + u'@' + value[2]
+        if value[3]:
+            return literal + u'^^<%s>' % value[3]
+        return literal
+
+    lines = [u'%s %s %s .\n' % tuple(term(v) for v in triple)
+             for triple in triples(content)]
+    return u''.join(lines).encode('utf-8')
+
+
+def jsonld(content):
+    """ Serialize a record as compact JSON-LD, using the prefixes from
+    NAMESPACES in the context. """
+    used = set()
+
+    def compact(uri):
+        for prefix, namespace in NAMESPACES.items():
+            if uri.startswith(namespace) and len(uri) > len(namespace):
+                used.add(prefix)
+                return '%s:%s' % (prefix, uri[len(namespace):])
+        return uri
+
+    def ref(value):
+        return value[1] if value[0] == 'uri' else '_:%s' % value[1]
+
+    nodes = collections.OrderedDict()
+    for subject, predicate, obj in triples(content):
+        current = nodes.setdefault(ref(subject), {'@id': ref(subject)})
+        if predicate[1] == RDF + 'type':
+            current.setdefault('@type', []).append(compact(obj[1]))
+            continue
+        if obj[0] == 'literal':
+            if obj[2]:
+                value = {'@value': obj[1], '@language': obj[2]}
+            elif obj[3]:
+                value = {'@value': obj[1], '@type': compact(obj[3])}
+            else:
+                value = obj[1]
+        else:
+            value = {'@id': ref(obj)}
+        current.setdefault(compact(predicate[1]), []).append(value)
+
+    context = dict((prefix, NAMESPACES[prefix]) for prefix in used)
+    return json.dumps({'@context': context, '@graph': list(nodes.values())},
+                      separators=(',', ':'), sort_keys=True)
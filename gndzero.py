@@ -9,27 +9,34 @@ instead.
 from __future__ import print_function
 
 from colorama import Fore, Back, Style
+from gndstore import HOME, TEMPDIR, LATEST, convert, dbopen, split, top
+from gndstore import ConversionError, jsonld, ntriples
 from luigi.task import flatten
 import collections
+import csv
 import datetime
-import itertools
+import fcntl
+import functools
+import gzip
+import hashlib
+import inspect
+import json
 import luigi
+import multiprocessing
+import numpy as np
 import os
 import pandas as pd
 import random
 import re
+import shutil
 import slugify
-import sqlite3
 import string
 import subprocess
 import sys
 import tempfile
 import urllib
 
-import config
-
-tempfile.tempdir = config.TEMPDIR
-HOME = config.HOME
+tempfile.tempdir = TEMPDIR
 
 
 #
@@ -54,14 +61,6 @@ def magenta(text):
     return Fore.MAGENTA + text + Fore.RESET
 
 
-def convert(name):
-    """
-    Convert CamelCase to underscore, http://stackoverflow.com/a/1176023/89391.
-    """
-    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1-\2', name)
-    return re.sub('([a-z0-9])([A-Z])', r'\1-\2', s1).lower()
-
-
 def which(program):
     """
     Return `None` if no executable can be found.
@@ -132,40 +131,262 @@ def random_tmp_path():
     return os.path.join(tempfile.gettempdir(), 'gndzero-%s' % random_string())
 
 
-def split(iterable, n):
+def records(path, shard=0, num_shards=1):
+    """
+    Yield the records of a dump, that is, the blocks of lines separated by
+    blank lines, as lists of stripped lines. With `num_shards` > 1, only yield
+    the records of the `shard`-th of `num_shards` equal sized byte ranges of
+    the file. A record belongs to the range, that contains the blank line
+    right before it (the first record belongs to the first nonempty range),
+    so every record is seen by exactly one shard.
     """
-    Generalized `pairwise`. Split an iterable after every `n` items.
+    size = os.path.getsize(path)
+    start = size * shard // num_shards
+    end = size * (shard + 1) // num_shards
+    if start == end:
+        return
+
+    # work on bytes, since the ranges may start inside a multibyte character;
+    # only complete records get decoded (on python 3)
+    with open(path, 'rb') as handle:
+        owned = (start == 0)
+        offset = start
+        if start > 0:
+            # skip the rest of the line, that started in the previous range
+            handle.seek(start - 1)
+            offset = start - 1 + len(handle.readline())
+        lines = []
+        while True:
+            line = handle.readline()
+            blank_offset, offset = offset, offset + len(line)
+            if line.strip():
+                if owned:
+                    lines.append(line.strip())
+                continue
+            if lines:
+                if str is bytes:
+                    yield lines
+                else:
+                    yield [line.decode('utf-8') for line in lines]
+                lines = []
+            if not line or blank_offset >= end:
+                break
+            owned = True
+
+
+def rowid_range(cursor, table, shard=0, num_shards=1):
     """
-    i = iter(iterable)
-    piece = tuple(itertools.islice(i, n))
-    while piece:
-        yield piece
-        piece = tuple(itertools.islice(i, n))
+    Return the half-open interval (low, high) of the `shard`-th of
+    `num_shards` equal sized rowid ranges of `table`.
+    """
+    cursor.execute("SELECT MIN(rowid), MAX(rowid) FROM %s" % table)
+    first, last = cursor.fetchone()
+    if first is None:
+        return 0, 0
+    size = last - first + 1
+    return (first + size * shard // num_shards,
+            first + size * (shard + 1) // num_shards)
 
 
-class dbopen(object):
+def components(n, source, target):
+    """
+    Return the weakly connected component labels of a graph with `n` nodes
+    and edges `source` -> `target` (integer arrays), that is, for every node
+    the smallest node id in its component. Array based union-find: hook the
+    larger root of every edge under the smaller one, then compress paths by
+    pointer jumping, until no edge connects two roots.
     """
-    Simple context manager for sqlite3 databases. Commits everything at exit.
+    parent = np.arange(n, dtype=np.int64)
+    while True:
+        low = np.minimum(parent[source], parent[target])
+        high = np.maximum(parent[source], parent[target])
+        hooks = low != high
+        if not hooks.any():
+            return parent
+        np.minimum.at(parent, high[hooks], low[hooks])
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def representations(row):
+    """ Convert an (id, content) row into (id, jsonld, ntriples), with
+    None values for records, that cannot be parsed. """
+    id, content = row
+    try:
+        return id, jsonld(content), ntriples(content)
+    except ConversionError:
+        return id, None, None
+
+
+#
+# content addressed reuse of artefacts, see GNDTask.digest
+#
+MANIFEST = os.path.abspath(os.path.join(HOME, 'gndzero', 'manifest.json'))
 
-        with dbopen('/tmp/test.db') as cursor:
-            query = cursor.execute('SELECT * FROM items')
-            result = query.fetchall()
-            ...
+# bump this, if something outside of the python code (e.g. an external
+# command) changes the outputs; the code itself is covered by `dependencies`
+CODE_VERSION = 1
+
+# modules, whose functions and classes are part of a task digest
+DIGESTED = (__name__, 'gndstore')
+
+
+class manifest(object):
     """
-    def __init__(self, path):
+    Context manager for the manifest, a JSON file with the content digests
+    of artefacts ("files") and the outputs produced for a task digest
+    ("outputs"). The manifest is locked while open, so parallel workers can
+    share it, and written back at exit.
+
+        with manifest() as data:
+            data['outputs'][key] = paths
+    """
+    def __init__(self, path=MANIFEST):
         self.path = path
-        self.conn = None
-        self.cursor = None
+        self.lock = None
+        self.data = None
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self.path)
-        self.conn.text_factory = str
-        self.cursor = self.conn.cursor()
-        return self.cursor
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = open(self.path + '.lock', 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.data = {'files': {}, 'outputs': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as handle:
+                self.data.update(json.load(handle))
+        return self.data
 
     def __exit__(self, exc_class, exc, traceback):
-        self.conn.commit()
-        self.conn.close()
+        try:
+            if exc_class is None:
+                stopover = self.path + '.tmp'
+                with open(stopover, 'w') as handle:
+                    json.dump(self.data, handle, indent=1, sort_keys=True)
+                os.rename(stopover, self.path)
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+
+
+def code_names(code):
+    """ All global and attribute names used in `code` and nested code. """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+
+def dependencies(klass):
+    """
+    Return the sources of the classes in the MRO of task `klass` and of the
+    functions and (non-task) classes of this module and gndstore, that they
+    use, directly or indirectly. Other tasks are covered by their outputs.
+    """
+    sources, seen = [], set()
+    todo = [cls for cls in inspect.getmro(klass)
+            if cls.__module__ in DIGESTED]
+    while todo:
+        obj = todo.pop()
+        if obj in seen:
+            continue
+        seen.add(obj)
+        sources.append(inspect.getsource(obj))
+        if inspect.isclass(obj):
+            functions = [value for value in vars(obj).values()
+                         if inspect.isfunction(value)]
+        else:
+            functions = [obj]
+        while functions:
+            function = functions.pop()
+            # decorated methods, e.g. by `reusable`, close over the original
+            for cell in function.__closure__ or ():
+                if inspect.isfunction(cell.cell_contents):
+                    functions.append(cell.cell_contents)
+            for name in code_names(function.__code__):
+                value = function.__globals__.get(name)
+                if (inspect.isfunction(value) or inspect.isclass(value)) and \
+                        getattr(value, '__module__', None) in DIGESTED and \
+                        not (inspect.isclass(value) and
+                             issubclass(value, luigi.Task)):
+                    todo.append(value)
+    return sorted(set(sources))
+
+
+def content_digest(path):
+    """
+    Return the SHA1 of a file. Digests are kept in the manifest with size
+    and modification time, so unchanged files are read only once.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with manifest() as data:
+        entry = data['files'].get(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['sha1']
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            sha.update(block)
+    with manifest() as data:
+        data['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                               'sha1': sha.hexdigest()}
+    return sha.hexdigest()
+
+
+def link(source, target):
+    """
+    Put `source` at `target` (atomically) as hard link, as copy if linking
+    is not possible, e.g. across devices. Sqlite databases are always
+    copied: they are opened for writing, and a write through one name must
+    not change the other (and its digest).
+    """
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    stopover = random_tmp_path()
+    if source.endswith('.db'):
+        shutil.copy2(source, stopover)
+    else:
+        try:
+            os.link(source, stopover)
+        except OSError:
+            shutil.copy2(source, stopover)
+    os.rename(stopover, target)
+
+
+def reusable(run):
+    """
+    Decorator for the `run` method of a GNDTask. If the manifest has outputs
+    for the same digest (same code, parameters and input content, see
+    GNDTask.digest), these are linked into place instead of running the
+    task. Otherwise the task runs and its outputs are recorded.
+    """
+    @functools.wraps(run)
+    def wrapper(self):
+        key = '%s-%s' % (self.__class__.__name__, self.digest())
+        outputs = [os.path.abspath(target.fn)
+                   for target in flatten(self.output())]
+        with manifest() as data:
+            previous = data['outputs'].get(key)
+
+        if (previous and previous != outputs and len(previous) == len(outputs)
+                and all(os.path.exists(path) for path in previous)):
+            for source, target in zip(previous, outputs):
+                print(green('reusing %s' % source), file=sys.stderr)
+                link(source, target)
+        else:
+            run(self)
+
+        with manifest() as data:
+            data['outputs'][key] = outputs
+    return wrapper
 
 
 class DefaultTask(luigi.Task):
@@ -218,9 +439,62 @@ class DefaultTask(luigi.Task):
 class GNDTask(DefaultTask):
     TAG = 'gndzero'
 
+    # parameters, that do not change the output
+    VOLATILE = ('date', 'workers')
+
     def latest(self):
-        """ Adjust this, if updates should be done regularly. """
-        return datetime.date(2013, 11, 8)
+        """ The date of the VIAF dump, see gndstore.LATEST. """
+        return LATEST
+
+    def digest(self):
+        """
+        A digest of everything the output of this task depends on: the code
+        of the task and the helpers it uses (see `dependencies`), its
+        parameters (except VOLATILE ones) and the content of its input files.
+        Tasks, whose `run` is `reusable`, are not rerun for a new date, if
+        the digest did not change.
+        """
+        parts = [self.__class__.__name__, str(CODE_VERSION)]
+        parts += dependencies(self.__class__)
+        parts += ['%s=%s' % (name, value)
+                  for name, value in sorted(self.param_kwargs.items())
+                  if name not in self.VOLATILE]
+        parts += [content_digest(target.fn) for target in flatten(self.input())
+                  if hasattr(target, 'fn')]
+
+        sha = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = part.encode('utf-8')
+            sha.update(part + b'\0')
+        return sha.hexdigest()
+
+
+class ShardedGNDTask(GNDTask):
+    """
+    A task, that can be run in `num_shards` parts, each working on an equal
+    sized range of record offsets. The shards can run in parallel (--workers)
+    or on different machines sharing HOME, `ShardMerge` combines them.
+    """
+    date = luigi.DateParameter(default=datetime.date.today())
+    shard = luigi.IntParameter(default=0)
+    num_shards = luigi.IntParameter(default=1)
+
+    def filename(self, ext):
+        """ The output filename; unsharded tasks keep the plain name. """
+        if self.num_shards > 1:
+            return '{date}-{shard:03d}-of-{num:03d}.{ext}'.format(
+                date=self.date, shard=self.shard, num=self.num_shards,
+                ext=ext)
+        return '{date}.{ext}'.format(date=self.date, ext=ext)
+
+    def merged(self, klass):
+        """ Require the complete output of the sharded task `klass`, which
+        is built in shards itself, if this task runs sharded. """
+        if self.num_shards > 1:
+            return ShardMerge(task=klass.__name__, date=self.date,
+                              num_shards=self.num_shards)
+        return klass(date=self.date)
 
 
 class Executable(luigi.Task):
@@ -278,7 +552,7 @@ class GNDDump(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.rdf.gz'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
 class GNDExtract(GNDTask):
@@ -289,25 +563,25 @@ class GNDExtract(GNDTask):
     def requires(self):
         return GNDDump(date=self.date)
 
+    @reusable
     def run(self):
         output = shellout("gunzip -c {input} > {output}", input=self.input().fn)
         luigi.File(output).move(self.output().fn)
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.rdf'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
-class SqliteDB(GNDTask):
+class SqliteDB(ShardedGNDTask):
     """ Turn the dump into a (id, content) sqlite3 db.
     This artefact will be used by the cache server.
     """
 
-    date = luigi.DateParameter(default=datetime.date.today())
-
     def requires(self):
         return GNDExtract(date=self.date)
 
+    @reusable
     def run(self):
         stopover = random_tmp_path()
         pattern = re.compile("""rdf:about="http://d-nb.info/gnd/([0-9X-]+)">""")
@@ -318,33 +592,76 @@ class SqliteDB(GNDTask):
             cursor.execute("""CREATE INDEX IF NOT EXISTS
                               idx_gnd_id ON gnd (id)""")
 
-            with self.input().open() as handle:
-                groups = itertools.groupby(handle, key=str.isspace)
-                for i, (k, lines) in enumerate(groups):
-                    if k:
-                        continue
-                    lines = map(string.strip, list(lines))
-                    match = pattern.search(lines[0])
-                    if match:
-                        row = (match.group(1), '\n'.join(lines))
-                        cursor.execute("INSERT INTO gnd VALUES (?, ?)", row)
+            for lines in records(self.input().fn, self.shard, self.num_shards):
+                match = pattern.search(lines[0])
+                if match:
+                    row = (match.group(1), '\n'.join(lines))
+                    cursor.execute("INSERT INTO gnd VALUES (?, ?)", row)
+
+        luigi.File(path=stopover).move(self.output().fn)
+
+    def output(self):
+        return luigi.LocalTarget(path=self.path(filename=self.filename('db')))
+
+
+class Representations(GNDTask):
+    """
+    Convert every record of SqliteDB into JSON-LD and N-Triples, in
+    parallel, so the cache server can serve them without any per-request
+    conversion. The representations are kept in a database of their own,
+    keyed by id, next to the SqliteDB artefact.
+    """
+    date = luigi.DateParameter(default=datetime.date.today())
+    workers = luigi.IntParameter(default=multiprocessing.cpu_count())
+
+    def requires(self):
+        return SqliteDB(date=self.date)
+
+    @reusable
+    def run(self):
+        stopover = random_tmp_path()
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            with dbopen(self.input().fn) as source:
+                source.execute("SELECT id, content FROM gnd ORDER BY rowid")
+                with dbopen(stopover) as cursor:
+                    cursor.execute("""CREATE TABLE representation
+                                      (id text PRIMARY KEY, jsonld blob,
+                                       ntriples blob)""")
+                    # sqlite3 objects must stay in this thread, so fetch the
+                    # rows here and hand batches to the pool
+                    for batch in split(source, 10000):
+                        rows = pool.map(representations, batch, chunksize=500)
+                        for id, document, triples in rows:
+                            if document is None:
+                                print(yellow('skipping unparsable record: '
+                                             '%s' % id), file=sys.stderr)
+                                continue
+                            cursor.execute("""INSERT INTO representation
+                                              VALUES (?, ?, ?)""",
+                                           (id, document, triples))
+            pool.close()
+            pool.join()
+        finally:
+            # a no-op after join, stops the workers on errors
+            pool.terminate()
 
         luigi.File(path=stopover).move(self.output().fn)
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.db'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
-class SameAs(GNDTask):
+class SameAs(ShardedGNDTask):
     """
     Extract owl:sameAs relationships from extracted dump.
     """
-    date = luigi.DateParameter(default=datetime.date.today())
 
     def requires(self):
         return GNDExtract(date=self.date)
 
+    @reusable
     def run(self):
         """ Example link to VIAF:
         <owl:sameAs rdf:resource="http://viaf.org/viaf/22508163" /> """
@@ -354,66 +671,163 @@ class SameAs(GNDTask):
         id_pattern = re.compile(
             """rdf:about="http://d-nb.info/gnd/([0-9X-]+)">""")
 
-        with self.input().open() as handle:
-            with self.output().open('w') as output:
-                groups = itertools.groupby(handle, key=str.isspace)
-                for i, (k, lines) in enumerate(groups):
-                    if k:
+        with self.output().open('w') as output:
+            for lines in records(self.input().fn, self.shard, self.num_shards):
+                match = id_pattern.search(lines[0])
+                if not match:
+                    continue
+                id = match.group(1)
+                for match in link_pattern.finditer('\n'.join(lines)):
+                    output.write('%s\t%s\n' % (id, match.group(1)))
+
+    def output(self):
+        return luigi.LocalTarget(path=self.path(filename=self.filename('tsv')))
+
+
+class VIAFCrosswalk(GNDTask):
+    """
+    A VIAF <-> GND crosswalk in an sqlite3 database, from the VIAF links
+    file (DNB entries) and the owl:sameAs links in the GND. VIAF ids are
+    stored as integers, the table is indexed in both directions.
+    """
+    date = luigi.DateParameter(default=datetime.date.today())
+
+    def requires(self):
+        return {
+            'viaf': VIAFDump(),
+            'sameas': SameAs(date=self.date)
+        }
+
+    @reusable
+    def run(self):
+        """ Example lines (tab separated):
+
+            http://viaf.org/viaf/100000001  DNB|1042143617     (links file)
+            118514768   http://viaf.org/viaf/24602065           (SameAs)
+        """
+        def links():
+            with gzip.open(self.input().get('viaf').fn) as handle:
+                for line in handle:
+                    parts = line.strip().split('\t')
+                    if len(parts) != 2 or not parts[1].startswith('DNB|'):
                         continue
-                    lines = map(string.strip, list(lines))
+                    gnd = parts[1][4:].rsplit('/', 1)[-1]
+                    yield int(parts[0].rsplit('/', 1)[-1]), gnd
 
-                    match = id_pattern.search(lines[0])
-                    if match:
-                        row = (match.group(1), '\n'.join(lines))
+            with self.input().get('sameas').open() as handle:
+                for line in handle:
+                    gnd, uri = line.strip().split('\t')
+                    if uri.startswith('http://viaf.org/viaf/'):
+                        viaf = uri.rstrip('/').rsplit('/', 1)[-1]
+                        if viaf.isdigit():
+                            yield int(viaf), gnd
+
+        stopover = random_tmp_path()
+        with dbopen(stopover) as cursor:
+            cursor.execute("""CREATE TABLE crosswalk (viaf integer, gnd text,
+                              PRIMARY KEY (viaf, gnd)) WITHOUT ROWID""")
+            cursor.executemany("INSERT OR IGNORE INTO crosswalk VALUES (?, ?)",
+                               links())
+            cursor.execute("""CREATE INDEX IF NOT EXISTS
+                              idx_crosswalk_gnd ON crosswalk (gnd, viaf)""")
 
-                    matches = re.finditer(link_pattern, '\n'.join(lines))
-                    for match in matches:
-                        output.write('%s\t%s\n' % (row[0], match.group(1)))
+        luigi.File(path=stopover).move(self.output().fn)
 
     def output(self):
-        return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+        return luigi.LocalTarget(path=self.path(filename='{date}.db'.format(
+                                                date=self.date)))
 
 
-class Successor(GNDTask):
+class Successor(ShardedGNDTask):
     """
     Store all outbound edges for a GND in a two column table.
-    This takes (toooo) long: 495m12.706s with a single process.
+    This takes (toooo) long: 495m12.706s with a single process,
+    so run it in shards: ShardMerge --task Successor.
     """
-    date = luigi.DateParameter(default=datetime.date.today())
 
     def requires(self):
-        return SqliteDB(date=self.date)
+        return self.merged(SqliteDB)
 
+    @reusable
     def run(self):
         pattern = re.compile("""http://d-nb.info/gnd/([0-9X-]+)""")
 
-        # fetch all gnds
-        idset = set()
-        with dbopen(self.input().fn) as cursor:
-            cursor.execute("SELECT id FROM gnd")
-            rows = cursor.fetchall()
-            for row in rows:
-                idset.add(row[0])
-
-        total, done = len(idset), 0
         with dbopen(self.input().fn) as cursor:
+            low, high = rowid_range(cursor, 'gnd', self.shard, self.num_shards)
+            cursor.execute("""SELECT id, content FROM gnd
+                              WHERE rowid >= ? AND rowid < ?
+                              ORDER BY rowid""", (low, high))
             with self.output().open('w') as output:
-                for batch in split(idset, 1000):
-                    print('{done}/{total}'.format(done=done, total=total))
-                    cursor.execute("""SELECT id, content FROM gnd
-                                      WHERE id IN (%s) """ % (
-                            ','.join([ "'%s'" % id for id in tuple(batch)])))
-                    rows = cursor.fetchall()
-                    for row in rows:
-                        id, content = row
-                        for match in pattern.finditer(content, 24):
-                            output.write('%s\t%s\n' % (id, match.group(1)))
-                        done += 1
+                for id, content in cursor:
+                    for match in pattern.finditer(content, 24):
+                        output.write('%s\t%s\n' % (id, match.group(1)))
 
     def output(self):
-        return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+        return luigi.LocalTarget(path=self.path(filename=self.filename('tsv')))
+
+
+class ShardMerge(GNDTask):
+    """
+    Run a sharded task in `num_shards` parts and combine the partial outputs
+    in shard order into the output of the unsharded task, so that downstream
+    tasks do not notice the difference. Example:
+
+        $ python gndzero.py ShardMerge --task Successor --num-shards 8 \\
+            --workers 8 --local-scheduler
+    """
+    task = luigi.Parameter()
+    date = luigi.DateParameter(default=datetime.date.today())
+    num_shards = luigi.IntParameter(default=4)
+
+    def sharded(self):
+        """ Return the class of the task to run in shards. """
+        klass = globals().get(self.task)
+        if not (isinstance(klass, type) and issubclass(klass, ShardedGNDTask)):
+            raise ValueError('Not a sharded task: %s' % self.task)
+        return klass
+
+    def requires(self):
+        klass = self.sharded()
+        return [klass(date=self.date, shard=shard, num_shards=self.num_shards)
+                for shard in range(self.num_shards)]
+
+    @reusable
+    def run(self):
+        stopover = random_tmp_path()
+        paths = [target.fn for target in self.input()]
+
+        if self.output().fn.endswith('.db'):
+            with dbopen(stopover) as cursor:
+                cursor.execute("ATTACH DATABASE ? AS shard", (paths[0],))
+                cursor.execute("""SELECT type, name, sql FROM shard.sqlite_master
+                                  WHERE sql IS NOT NULL""")
+                schema = cursor.fetchall()
+                cursor.execute("DETACH DATABASE shard")
+
+                tables = [name for type, name, _ in schema if type == 'table']
+                for type, name, sql in schema:
+                    if type == 'table':
+                        cursor.execute(sql)
+                for path in paths:
+                    cursor.execute("ATTACH DATABASE ? AS shard", (path,))
+                    for name in tables:
+                        cursor.execute("INSERT INTO main.%s SELECT * FROM shard.%s" %
+                                       (name, name))
+                    cursor.connection.commit()
+                    cursor.execute("DETACH DATABASE shard")
+                for type, name, sql in schema:
+                    if type == 'index':
+                        cursor.execute(sql)
+        else:
+            with open(stopover, 'wb') as output:
+                for path in paths:
+                    with open(path, 'rb') as handle:
+                        shutil.copyfileobj(handle, output)
+
+        luigi.File(path=stopover).move(self.output().fn)
+
+    def output(self):
+        return self.sharded()(date=self.date).output()
 
 
 class SuccessorDB(GNDTask):
@@ -425,6 +839,7 @@ class SuccessorDB(GNDTask):
     def requires(self):
         return Successor(date=self.date)
 
+    @reusable
     def run(self):
         stopover = random_tmp_path()
 
@@ -450,7 +865,7 @@ class SuccessorDB(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.db'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
 class Reach(GNDTask):
@@ -465,6 +880,7 @@ class Reach(GNDTask):
     def requires(self):
         return Successor(date=self.date)
 
+    @reusable
     def run(self):
         lookup = collections.defaultdict(set)
         with self.input().open() as handle:
@@ -487,7 +903,7 @@ class Reach(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
 class TranslationMap(GNDTask):
@@ -500,6 +916,7 @@ class TranslationMap(GNDTask):
     def requires(self):
         return SqliteDB(date=self.date)
 
+    @reusable
     def run(self):
         sequential_id = 0
         with dbopen(self.input().fn) as cursor:
@@ -512,7 +929,7 @@ class TranslationMap(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
 class TranslatedSuccessor(GNDTask):
@@ -527,6 +944,7 @@ class TranslatedSuccessor(GNDTask):
             'map': TranslationMap(date=self.date),
         }
 
+    @reusable
     def run(self):
         mapping = {}
         with self.input().get('map').open() as handle:
@@ -544,17 +962,18 @@ class TranslatedSuccessor(GNDTask):
                     try:
                         output.write('%s\t%s\n' % (mapping[id],
                                                    mapping[successor]))
-                    except KeyError as err:
+                    except KeyError:
                         # TODO: these IDs are defined, but are not caught by the
-                        # extraction regex
-                        misses.add(id)
-                        print('missed', id)
+                        # extraction regex; GraphStats lists them
+                        misses.add(successor if id in mapping else id)
 
-        print(len(misses))
+        if misses:
+            print(yellow('skipped links with %s unknown ids' % len(misses)),
+                  file=sys.stderr)
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
 class TranslatedSuccessorCompact(GNDTask):
@@ -567,6 +986,7 @@ class TranslatedSuccessorCompact(GNDTask):
         return TranslatedSuccessor(date=self.date)
 
 
+    @reusable
     def run(self):
         graph = collections.defaultdict(set)
         with self.input().open() as handle:
@@ -581,7 +1001,93 @@ class TranslatedSuccessorCompact(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
+
+
+class GraphStats(GNDTask):
+    """
+    Degrees, weakly connected components and dangling links of the GND
+    graph, computed on arrays. Writes the per node arrays (in/out degree,
+    component label), the degree distributions and the unresolvable link
+    targets into a compressed .npz and a summary as JSON.
+    """
+    date = luigi.DateParameter(default=datetime.date.today())
+
+    def requires(self):
+        return {
+            'edges': TranslatedSuccessor(date=self.date),
+            'map': TranslationMap(date=self.date),
+            'successor': Successor(date=self.date),
+        }
+
+    @reusable
+    def run(self):
+        ids = pd.read_csv(self.input().get('map').fn, sep='\t', header=None,
+                          names=('id', 'intid'), usecols=['id'], dtype=object,
+                          quoting=csv.QUOTE_NONE).id
+        n = len(ids)
+
+        edges = np.fromfile(self.input().get('edges').fn, dtype=np.int64,
+                            sep=' ').reshape(-1, 2)
+        source, target = edges[:, 0], edges[:, 1]
+        outdegree = np.bincount(source, minlength=n).astype(np.int32)
+        indegree = np.bincount(target, minlength=n).astype(np.int32)
+        labels = components(n, source, target)
+        sizes = np.bincount(labels, minlength=n)
+        sizes = sizes[sizes > 0]
+
+        links = pd.read_csv(self.input().get('successor').fn, sep='\t',
+                            header=None, names=('id', 'successor'),
+                            dtype=object, quoting=csv.QUOTE_NONE)
+        dangling = links.successor[~links.successor.isin(ids)]
+        unresolved = dangling.value_counts()
+
+        hubs = np.argsort(indegree)[::-1][:20]
+        summary = {
+            'nodes': n,
+            'edges': len(edges),
+            'links': len(links),
+            'degree': {
+                'max_in': int(indegree.max()) if n else 0,
+                'max_out': int(outdegree.max()) if n else 0,
+                'mean': float(len(edges)) / n if n else 0.0,
+                'no_in': int((indegree == 0).sum()),
+                'no_out': int((outdegree == 0).sum()),
+                'isolated': int(((indegree == 0) & (outdegree == 0)).sum()),
+            },
+            'top_in': [[ids.values[i], int(indegree[i])] for i in hubs],
+            'components': {
+                'count': len(sizes),
+                'largest': int(sizes.max()) if len(sizes) else 0,
+                'singletons': int((sizes == 1).sum()),
+            },
+            'unresolved': {
+                'links': len(dangling),
+                'targets': len(unresolved),
+                'top': [[id, int(count)] for id, count
+                        in zip(unresolved.index[:20], unresolved.values[:20])],
+            },
+        }
+
+        stopover = random_tmp_path()
+        with open(stopover, 'wb') as output:
+            np.savez_compressed(output, indegree=indegree, outdegree=outdegree,
+                                component=labels.astype(np.int32),
+                                indegree_distribution=np.bincount(indegree),
+                                outdegree_distribution=np.bincount(outdegree),
+                                unresolved=np.array(unresolved.index, dtype='S'))
+        luigi.File(stopover).move(self.output().get('arrays').fn)
+
+        with self.output().get('summary').open('w') as output:
+            json.dump(summary, output, indent=2, sort_keys=True)
+
+    def output(self):
+        return {
+            'arrays': luigi.LocalTarget(path=self.path(
+                filename='{date}.npz'.format(date=self.date))),
+            'summary': luigi.LocalTarget(path=self.path(
+                filename='{date}.json'.format(date=self.date))),
+        }
 
 
 class PageRank(GNDTask):
@@ -597,6 +1103,7 @@ class PageRank(GNDTask):
                 msg='See: https://github.com/miku/gopagerank')
         }
 
+    @reusable
     def run(self):
         temp = shellout("pagerank {input} > {output}",
                         input=self.input().get('data').fn)
@@ -604,7 +1111,7 @@ class PageRank(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
 class TranslatePageRank(GNDTask):
@@ -619,6 +1126,7 @@ class TranslatePageRank(GNDTask):
             'pagerank': PageRank(date=self.date)
         }
 
+    @reusable
     def run(self):
         mapping = {}
         with self.input().get('map').open() as handle:
@@ -634,48 +1142,103 @@ class TranslatePageRank(GNDTask):
 
     def output(self):
         return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+                                                date=self.date)))
 
 
-class PreferredNameFile(GNDTask):
+class PreferredNameFile(ShardedGNDTask):
     """
     Extract all preferred names add create a single file
     with id, preferred name.
 
-    Well, 661m26.249s.
+    Well, 661m26.249s. Run it in shards: ShardMerge --task PreferredNameFile.
     """
-    date = luigi.DateParameter(default=datetime.date.today())
 
     def requires(self):
-        return SqliteDB(date=self.date)
+        return self.merged(SqliteDB)
 
+    @reusable
     def run(self):
-        # fetch all gnds
-        idset = set()
-        with dbopen(self.input().fn) as cursor:
-            cursor.execute("SELECT id FROM gnd")
-            rows = cursor.fetchall()
-            for row in rows:
-                idset.add(row[0])
-
         pattern = re.compile("<(gnd:preferred[^>]*)>(.*?)</gnd:preferred")
         with dbopen(self.input().fn) as cursor:
+            low, high = rowid_range(cursor, 'gnd', self.shard, self.num_shards)
+            cursor.execute("""SELECT id, content FROM gnd
+                              WHERE rowid >= ? AND rowid < ?
+                              ORDER BY rowid""", (low, high))
             with self.output().open('w') as output:
-                for id in idset:
-                    cursor.execute("SELECT content FROM gnd WHERE id = ?", (id,))
-                    content = cursor.fetchone()[0]
+                for id, content in cursor:
                     match = pattern.search(content)
                     if match:
                         output.write('%s\t%s\t%s\n' % (id, match.group(2), match.group(1)))
 
     def output(self):
-        return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+        return luigi.LocalTarget(path=self.path(filename=self.filename('tsv')))
+
+
+class NameIndex(GNDTask):
+    """
+    Full-text index (sqlite3 FTS5) over the preferred names, for the
+    search endpoint of the cache server. The rows are inserted in
+    descending PageRank order, so that the rowid order of the index is
+    the PageRank order and a plain LIMIT yields the most popular matches.
+    """
+    date = luigi.DateParameter(default=datetime.date.today())
+
+    def requires(self):
+        return {
+            'pagerank': TranslatePageRank(date=self.date),
+            'names': PreferredNameFile(date=self.date)
+        }
+
+    @reusable
+    def run(self):
+        stopover = random_tmp_path()
+        with dbopen(stopover) as cursor:
+            cursor.execute("""CREATE TEMP TABLE names
+                              (id text PRIMARY KEY, name text, kind text)""")
+            cursor.execute("""CREATE TEMP TABLE pagerank
+                              (id text PRIMARY KEY, pagerank real)""")
+
+            with self.input().get('names').open() as handle:
+                rows = (line.rstrip('\n').split('\t', 2) for line in handle)
+                cursor.executemany("INSERT OR IGNORE INTO names VALUES (?, ?, ?)",
+                                   rows)
+            with self.input().get('pagerank').open() as handle:
+                rows = (line.strip().split() for line in handle)
+                cursor.executemany("INSERT OR IGNORE INTO pagerank VALUES (?, ?)",
+                                   rows)
+
+            cursor.execute("""CREATE TABLE name
+                              (id text, name text, kind text, pagerank real)""")
+            cursor.execute("""INSERT INTO name (id, name, kind, pagerank)
+                              SELECT names.id, name, kind,
+                                     COALESCE(pagerank.pagerank, 0)
+                              FROM names LEFT JOIN pagerank
+                              ON names.id = pagerank.id
+                              ORDER BY 4 DESC, names.id""")
+            cursor.execute("""CREATE INDEX IF NOT EXISTS
+                              idx_name_id ON name (id)""")
+
+            cursor.execute("""CREATE VIRTUAL TABLE name_fts USING fts5
+                              (name, content='name', content_rowid='rowid',
+                               prefix='2 3',
+                               tokenize='unicode61 remove_diacritics 1')""")
+            cursor.execute("""INSERT INTO name_fts (rowid, name)
+                              SELECT rowid, name FROM name""")
+            cursor.execute("INSERT INTO name_fts (name_fts) VALUES ('optimize')")
+
+        luigi.File(path=stopover).move(self.output().fn)
+
+    def output(self):
+        return luigi.LocalTarget(path=self.path(filename='{date}.db'.format(
+                                                date=self.date)))
 
 
 class HumanReadablePageRank(GNDTask):
-    """ Add the concept name to the PageRank list. """
+    """ Add the concept name to the PageRank list. If `top_k` is set, only
+    the `top_k` highest ranked concepts are selected (streaming, before the
+    join), which keeps memory usage small. """
     date = luigi.DateParameter(default=datetime.date.today())
+    top_k = luigi.IntParameter(default=0)
 
     def requires(self):
         return {
@@ -683,20 +1246,69 @@ class HumanReadablePageRank(GNDTask):
             'names': PreferredNameFile(date=self.date)
         }
 
+    @reusable
     def run(self):
-        pagerank = pd.read_csv(self.input().get('pagerank').fn, sep='\t',
-                               names=('id', 'pagerank'))
-        names = pd.read_csv(self.input().get('names').fn, sep='\t',
-                            names=('id', 'name', 'kind'))
-        df = pagerank.merge(names)
+        if self.top_k > 0:
+            rows = top(self.input().get('pagerank').fn, self.top_k)
+            pagerank = pd.DataFrame(rows, columns=('id', 'pagerank'))
+            wanted = set(pagerank.id)
+            with self.input().get('names').open() as handle:
+                rows = [line.rstrip('\n').split('\t', 2) for line in handle
+                        if line.split('\t', 1)[0] in wanted]
+            names = pd.DataFrame(rows, columns=('id', 'name', 'kind'))
+        else:
+            pagerank = pd.read_csv(self.input().get('pagerank').fn, sep='\t',
+                                   names=('id', 'pagerank'),
+                                   dtype={'id': object, 'pagerank': 'float64'})
+            names = pd.read_csv(self.input().get('names').fn, sep='\t',
+                                names=('id', 'name', 'kind'), dtype=object,
+                                quoting=csv.QUOTE_NONE)
+
+        pagerank['pagerank'] = pagerank.pagerank.astype('float64')
+        names['kind'] = names.kind.astype('category')
+        df = pagerank.merge(names, on='id')
+        df = df.sort_values('pagerank', ascending=False, kind='mergesort')
         with self.output().open('w') as output:
-            df = df.sort(columns=['pagerank'], ascending=False)
-            df.to_csv(output, sep='\t', cols=('id', 'pagerank', 'name', 'kind'),
+            df.to_csv(output, sep='\t', columns=('id', 'pagerank', 'name', 'kind'),
                       index=False, header=False)
 
     def output(self):
-        return luigi.LocalTarget(path=self.path(filename='{date}.tsv'.format(
-                                                date=self.latest())))
+        if self.top_k > 0:
+            filename = '{date}-top-{k}.tsv'.format(date=self.date, k=self.top_k)
+        else:
+            filename = '{date}.tsv'.format(date=self.date)
+        return luigi.LocalTarget(path=self.path(filename=filename))
+
+
+class HumanReadablePageRankColumnar(GNDTask):
+    """ The human readable PageRank list as Feather or Parquet file, for fast
+    loading into dashboards. Requires pyarrow. """
+    date = luigi.DateParameter(default=datetime.date.today())
+    top_k = luigi.IntParameter(default=0)
+    format = luigi.Parameter(default='feather')
+
+    def requires(self):
+        return HumanReadablePageRank(date=self.date, top_k=self.top_k)
+
+    @reusable
+    def run(self):
+        if self.format not in ('feather', 'parquet'):
+            raise ValueError('format must be feather or parquet: %s' % self.format)
+        df = pd.read_csv(self.input().fn, sep='\t',
+                         names=('id', 'pagerank', 'name', 'kind'),
+                         dtype={'id': object, 'pagerank': 'float64',
+                                'name': object, 'kind': 'category'})
+        stopover = random_tmp_path()
+        if self.format == 'feather':
+            df.to_feather(stopover)
+        else:
+            df.to_parquet(stopover, index=False)
+        luigi.File(stopover).move(self.output().fn)
+
+    def output(self):
+        stem = os.path.splitext(os.path.basename(self.input().fn))[0]
+        return luigi.LocalTarget(path=self.path(filename='{stem}.{ext}'.format(
+                                                stem=stem, ext=self.format)))
 
 
 if __name__ == '__main__':
@@ -65,16 +65,137 @@ Percentage of the requests served within a certain time (ms)
 
 """
 
-from flask import Flask, Response, url_for, request, jsonify, redirect, abort
-from gndzero import dbopen, SqliteDB
-import requests
+from __future__ import print_function
+
+from flask import (Blueprint, Flask, Response, url_for, request, jsonify,
+                   redirect, abort, current_app, g)
+from gndstore import (HOME, TAG, ConversionError, LRUCache, artifact, dbopen,
+                      split, setting, newest, resolve, ranked, requested,
+                      unwrap, jsonld, ntriples)
+import gc
+import math
+import numbers
+import os
 import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+blueprint = Blueprint('gnd', __name__)
+
+# mimetypes we can serve, the first one is the default; the others map to
+# a column in REPRESENTATIONS and a converter for records not in there
+MIMETYPES = ['text/xml', 'application/rdf+xml', 'application/ld+json',
+             'application/json', 'application/n-triples', 'text/plain']
+FORMATS = {
+    'application/ld+json': ('jsonld', jsonld),
+    'application/json': ('jsonld', jsonld),
+    'application/n-triples': ('ntriples', ntriples),
+    'text/plain': ('ntriples', ntriples),
+}
+
+# links to d-nb.info, that are rewritten to point to the local installation
+GND_URL = re.compile(r"http://d-nb\.info/gnd/([0-9a-zA-Z-]+)")
+
+# number of matches (in PageRank order) considered for ranking and the
+# weight of the (log) PageRank relative to the text match score
+SEARCH_CANDIDATES = 200
+SEARCH_PAGERANK_WEIGHT = 1.0
+
+# records downloaded on a cache miss, see `store`
+CACHE_SCHEMA = """CREATE TABLE IF NOT EXISTS gnd
+                  (id text PRIMARY KEY, content blob,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
+
+# the databases of a dataset besides the records (DB, built by SqliteDB):
+# the setting and the pipeline task building it
+DATABASES = (('NAMES', 'NameIndex'), ('CROSSWALK', 'VIAFCrosswalk'),
+             ('REPRESENTATIONS', 'Representations'))
+
+
+class Dataset(object):
+    """
+    The GND databases the server reads from, together with their version
+    and a response cache. Databases not given in `config` are pipeline
+    outputs: the newest SqliteDB and the outputs for the same dump of the
+    other tasks. The version is the name of the records database, that is
+    the date of its dump. Requests hold on to the dataset they started
+    with, so a switch to a new one does not affect them.
+    """
+    def __init__(self, config):
+        self.path = (config.get('DB') or newest('SqliteDB') or
+                     artifact('SqliteDB'))
+        filename = os.path.basename(self.path)
+        self.paths = {'DB': self.path}
+        for name, task in DATABASES:
+            path = artifact(task, filename=filename)
+            if task != 'Representations' and not os.path.exists(path):
+                # built later than the records; until then search and the
+                # crosswalk use the previous dump, representations are
+                # converted on the fly
+                path = newest(task) or path
+            self.paths[name] = config.get(name) or path
+        self.responses = LRUCache(config['RESPONSE_CACHE_BYTES'])
+        self.version = os.path.splitext(os.path.basename(self.path))[0]
+
+
+class Watcher(threading.Thread):
+    """
+    Look for newer pipeline outputs every `interval` seconds. If there are
+    any, warm them up in the background and then switch new requests over
+    to all of them at once.
+    """
+    def __init__(self, app, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as err:
+                print('watcher: %s' % err, file=sys.stderr)
+
+    def check(self):
+        current = self.app.extensions['dataset']
+        dataset = Dataset(self.app.config)
+        if dataset.paths == current.paths or not os.path.exists(dataset.path):
+            return
+        with dbopen(dataset.path, readonly=True) as cursor:
+            cursor.execute("SELECT id FROM gnd LIMIT 1")
+        warmup(self.app, dataset)
+        self.app.extensions['dataset'] = dataset
+        # release the memory, requests still running just miss the cache
+        current.responses.clear()
+        print('switched to %s' % ', '.join(sorted(dataset.paths.values())),
+              file=sys.stderr)
+
+
+def watch(app):
+    """
+    Start the watcher for this process, if enabled. Threads do not survive
+    a fork, so every (gunicorn) worker starts its own.
+    """
+    if app.config['WATCH_SECONDS'] <= 0:
+        return
+    with app.extensions['watcher.lock']:
+        if app.extensions.get('watcher.pid') == os.getpid():
+            return
+        app.extensions['watcher.pid'] = os.getpid()
+        Watcher(app, app.config['WATCH_SECONDS']).start()
 
-app = Flask(__name__)
 
-# the current database, must already be in place
-task = SqliteDB()
-DB = '/tmp/test.db'
+def etag(version, body):
+    """ An entity tag for a response body, scoped by dataset version. """
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    return '%s-%08x' % (version, zlib.crc32(body) & 0xffffffff)
+
 
 def wrap(s, rewrite=True, header=True):
     """
@@ -97,10 +218,7 @@ def wrap(s, rewrite=True, header=True):
                      xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
                      xmlns:skos="http://www.w3.org/2004/02/skos/core#">"""
     if rewrite:
-        for match in re.finditer(r"http://d-nb.info/gnd/([0-9a-zA-Z-]+)", s):
-            gnd = match.group(1)
-            s = s.replace("http://d-nb.info/gnd/{gnd}".format(gnd=gnd),
-                          url_for('cache', gnd=gnd, _external=True))
+        s = relink(s)
 
     if header:
         return "%s\n%s\n</rdf:RDF>" % (HEADER, s)
@@ -108,66 +226,361 @@ def wrap(s, rewrite=True, header=True):
         return "%s\n" % (s)
 
 
-@app.route("/cache", methods=["PUT"])
+def relink(s):
+    """
+    Rewrite GND URLs to point to the local installation, as reached by the
+    current request, or to BASE_URL, if set.
+    """
+    base = current_app.config['BASE_URL']
+    prefix = url_for('.cache', gnd='0', _external=not base)[:-1]
+    if base:
+        prefix = base.rstrip('/') + prefix
+    return GND_URL.sub(lambda match: prefix + match.group(1), s)
+
+
+def readonly(path):
+    """
+    Open one of the (read-only) pipeline databases, answer with 503, if it
+    is not there (yet).
+    """
+    if not os.path.exists(path):
+        abort(503)
+    return dbopen(path, readonly=True)
+
+
+def representation(dataset, gnd, content, column, converter):
+    """
+    Return the precomputed representation of a record. Records, that have
+    been added to the cache later, are converted on the fly.
+    """
+    path = dataset.paths['REPRESENTATIONS']
+    if os.path.exists(path):
+        with dbopen(path, readonly=True) as cursor:
+            cursor.execute("""SELECT %s FROM representation
+                              WHERE id = ?""" % column, (gnd,))
+            result = cursor.fetchone()
+            if result:
+                return result[0]
+    return converter(content)
+
+
+def record(dataset, gnd):
+    """
+    Return the content of record `gnd` from the dataset or, if it has been
+    downloaded later, from the CACHE database; None, if it is in neither.
+    The dataset itself is never written to.
+    """
+    for path in (dataset.path, current_app.config['CACHE']):
+        if not os.path.exists(path):
+            continue
+        with dbopen(path, readonly=True) as cursor:
+            try:
+                cursor.execute("SELECT content FROM gnd WHERE id = ?", (gnd,))
+            except sqlite3.OperationalError:
+                # no table (yet), e.g. after DELETE /cache
+                continue
+            result = cursor.fetchone()
+        if result:
+            return result[0]
+    return None
+
+
+def cachedb():
+    """ Open the (writable) CACHE database, the only one the server writes. """
+    path = current_app.config['CACHE']
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return dbopen(path)
+
+
+def store(gnd, content):
+    """ Add a downloaded record to the CACHE database. """
+    with cachedb() as cursor:
+        cursor.execute(CACHE_SCHEMA)
+        cursor.execute("""INSERT OR REPLACE INTO gnd (id, content)
+                          VALUES (?, ?)""", (gnd, content))
+
+
+def render(dataset, gnd, mimetype, rewrite=True):
+    """
+    Return the body of the response for record `gnd` as `mimetype`, or
+    None, if the record is not in the dataset. Rendered responses are
+    kept in the response cache as they are, independent of the host; links
+    in RDF/XML are rewritten for every request.
+    """
+    # text/xml and application/rdf+xml (or the two JSON-LD types) share
+    key = (gnd, FORMATS[mimetype][0] if mimetype in FORMATS else 'rdfxml')
+    body = dataset.responses.get(key)
+    if body is None:
+        content = record(dataset, gnd)
+        if content is None:
+            return None
+        if mimetype in FORMATS:
+            body = representation(dataset, gnd, content, *FORMATS[mimetype])
+        else:
+            body = wrap(content, rewrite=False, header=True)
+        dataset.responses.put(key, body)
+
+    if rewrite and mimetype not in FORMATS:
+        return relink(body)
+    return body
+
+
+def warmup(app, dataset=None):
+    """
+    Prefetch the most popular records and their (RDF/XML) responses into
+    the page cache and the response cache. Popular means most requested in
+    WARMUP_LOG, if given, otherwise highest ranked in WARMUP_RANKING. Stops
+    after WARMUP_TOP records, WARMUP_SECONDS or when the response cache
+    (RESPONSE_CACHE_BYTES) is full, whatever comes first.
+    """
+    dataset = dataset or app.extensions['dataset']
+    config = app.config
+    if config['WARMUP_LOG']:
+        ids = requested(config['WARMUP_LOG'], config['WARMUP_TOP'])
+    elif os.path.exists(config['WARMUP_RANKING']):
+        ids = ranked(config['WARMUP_RANKING'], config['WARMUP_TOP'])
+    else:
+        return 0
+
+    responses = dataset.responses
+    deadline = time.time() + config['WARMUP_SECONDS']
+    warmed = 0
+    with app.test_request_context():
+        for gnd in ids:
+            if time.time() > deadline or responses.full():
+                break
+            if render(dataset, gnd, MIMETYPES[0], rewrite=False) is not None:
+                warmed += 1
+    print('warmed up %s records (%s bytes) of %s' % (
+          warmed, responses.size, dataset.version), file=sys.stderr)
+    return warmed
+
+
+@blueprint.before_app_request
+def before_request():
+    g.dataset = current_app.extensions['dataset']
+    watch(current_app)
+
+
+@blueprint.after_app_request
+def after_request(response):
+    dataset = getattr(g, 'dataset', None)
+    if dataset is not None:
+        response.headers['X-Dataset-Version'] = dataset.version
+    return response
+
+
+@blueprint.route("/cache", methods=["PUT"])
 def create_cache():
-    with dbopen(DB) as cursor:
-        cursor.execute("""CREATE TABLE IF NOT EXISTS gnd
-                          (id text PRIMARY KEY, content blob,
-                          updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+    with cachedb() as cursor:
+        cursor.execute(CACHE_SCHEMA)
         cursor.execute("""CREATE INDEX IF NOT EXISTS
                               idx_gnd_id ON gnd (id)""")
+    g.dataset.responses.clear()
     return jsonify(cache="ok")
 
 
-@app.route("/cache", methods=["DELETE"])
+@blueprint.route("/cache", methods=["DELETE"])
 def drop_cache():
-    with dbopen(DB) as cursor:
+    with cachedb() as cursor:
         cursor.execute("""DROP TABLE IF EXISTS gnd """)
         cursor.execute("""DROP INDEX IF EXISTS idx_gnd_id""")
+    g.dataset.responses.clear()
     return jsonify(cache="dropped")
 
 
-@app.route("/gnd/<gnd>", methods=["GET"])
+@blueprint.route("/gnd/<gnd>", methods=["GET"])
 def cache_bc(gnd):
     """ Backwards compatibility. """
-    return redirect(url_for('cache', gnd=gnd))
+    return redirect(url_for('.cache', gnd=gnd))
 
 
-@app.route("/cache/<gnd>", methods=["GET"])
+@blueprint.route("/cache/<gnd>", methods=["GET"])
 def cache(gnd):
-    """ http://d-nb.info/gnd/118514768/about/rdf """
-    with dbopen(DB) as cursor:
-        query = cursor.execute("""SELECT content FROM gnd
-                                  WHERE id = ?""", (gnd,))
-        result = query.fetchone()
-        if not result:
-            # download and store
+    """ http://d-nb.info/gnd/118514768/about/rdf
+
+    The representation is chosen by the Accept header: RDF/XML (default),
+    JSON-LD or N-Triples. Only RDF/XML links are rewritten. Records, that
+    cannot be converted, are answered with 406. """
+    mimetype = request.accept_mimetypes.best_match(MIMETYPES,
+                                                   default=MIMETYPES[0])
+    rewrite = request.args.get('rewrite', True) in (True, 'on', '1', 1, 'yes')
+
+    try:
+        body = render(g.dataset, gnd, mimetype, rewrite=rewrite)
+        if body is None:
+            # download and store, like the records in SqliteDB
+            import requests
             r = requests.get("http://d-nb.info/gnd/{gnd}/about/rdf".format(gnd=gnd))
-            if r.status_code == 200:
-                cursor.execute("""INSERT INTO gnd (id, content)
-                                  VALUES (?, ?)""", (gnd, r.text))
-            else:
+            if r.status_code != 200:
                 # pass on the d-nb.info status code
                 abort(r.status_code)
+            store(gnd, unwrap(r.text))
+            body = render(g.dataset, gnd, mimetype, rewrite=rewrite)
+            if body is None:
+                abort(404)
+    except ConversionError:
+        abort(406)
 
-        query = cursor.execute("""SELECT content FROM gnd
-                                  WHERE id = ?""", (gnd,))
-        result = query.fetchone()
-        if not result:
-            abort(404)
-        wrapped = wrap(result[0], rewrite=request.args.get('rewrite', True),
-                       header=True)
-        return Response(response=wrapped, status=200, headers=None,
-                        mimetype='text/xml',
-                        content_type='text/xml; charset=utf-8',
+    response = Response(response=body, status=200, headers={'Vary': 'Accept'},
+                        mimetype=mimetype,
+                        content_type='%s; charset=utf-8' % mimetype,
                         direct_passthrough=False)
+    response.set_etag(etag(g.dataset.version, body))
+    return response.make_conditional(request)
+
+
+@blueprint.route("/viaf/<int:viaf>", methods=["GET"])
+def viaf(viaf):
+    """ The GND record for a VIAF id, e.g. /viaf/24602065 """
+    with readonly(g.dataset.paths['CROSSWALK']) as cursor:
+        cursor.execute("""SELECT gnd FROM crosswalk WHERE viaf = ?
+                          ORDER BY gnd LIMIT 1""", (viaf,))
+        result = cursor.fetchone()
+    if not result:
+        abort(404)
+    return cache(result[0])
+
 
+def viaf_id(value):
+    """ A VIAF id from an integer or a string of digits, None otherwise. """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, numbers.Integral):
+        return int(value) if value >= 0 else None
+    if isinstance(value, (str, type(u''))):
+        value = value.strip()
+        if re.match(r'^[0-9]+$', value):
+            return int(value)
+    return None
 
-@app.route("/")
+
+@blueprint.route("/viaf", methods=["GET", "POST"])
+def viaf_batch():
+    """ Resolve many VIAF ids at once, either as /viaf?ids=24602065,... or
+    as POST with a JSON list of ids. Returns a mapping from VIAF id to
+    the list of GNDs. """
+    if request.method == 'POST':
+        ids = request.get_json(force=True)
+        if not isinstance(ids, list):
+            abort(400)
+    else:
+        ids = request.args.get('ids', '').split(',')
+    # skip empty entries, like in ?ids=1,,2
+    ids = [viaf_id(id) for id in ids
+           if not isinstance(id, (str, type(u''))) or id.strip()]
+    if None in ids:
+        abort(400)
+    ids = sorted(set(ids))
+    if len(ids) > 1000:
+        abort(413)
+
+    mapping = dict((str(id), []) for id in ids)
+    with readonly(g.dataset.paths['CROSSWALK']) as cursor:
+        for batch in split(ids, 500):
+            cursor.execute("""SELECT viaf, gnd FROM crosswalk
+                              WHERE viaf IN (%s)""" % ','.join('?' * len(batch)),
+                           batch)
+            for viaf, gnd in cursor.fetchall():
+                mapping[str(viaf)].append(gnd)
+    return jsonify(**mapping)
+
+
+@blueprint.route("/search", methods=["GET"])
+def search():
+    """ Prefix search over preferred names, e.g. /search?q=goethe+joh&limit=10
+    Matches are ranked by text match (bm25) blended with PageRank. """
+    terms = re.findall(r'\w+', request.args.get('q', ''), re.UNICODE)
+    if not terms:
+        return jsonify(results=[])
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    query = ' '.join('"%s"*' % term for term in terms)
+
+    with readonly(g.dataset.paths['NAMES']) as cursor:
+        cursor.execute("""SELECT name.id, name.name, name.kind, name.pagerank,
+                                 hit.score
+                          FROM (SELECT rowid, bm25(name_fts) AS score
+                                FROM name_fts WHERE name_fts MATCH ?
+                                LIMIT ?) AS hit
+                          JOIN name ON name.rowid = hit.rowid""",
+                       (query, SEARCH_CANDIDATES))
+        rows = cursor.fetchall()
+
+    # bm25 is negative, smaller is better
+    rows.sort(key=lambda row: row[4] - SEARCH_PAGERANK_WEIGHT *
+              math.log(max(row[3], 1e-12)))
+    results = [dict(id=id, name=name, kind=kind, pagerank=pagerank)
+               for id, name, kind, pagerank, _ in rows[:limit]]
+    return jsonify(results=results)
+
+
+@blueprint.route("/ready")
+def ready():
+    """ For load balancers: 200, if the dataset is in place, 503 otherwise. """
+    status = 200 if os.path.exists(g.dataset.path) else 503
+    return jsonify(ready=(status == 200), version=g.dataset.version), status
+
+
+@blueprint.route("/")
 def index():
-    example = url_for('cache', gnd='118514768')
+    example = url_for('.cache', gnd='118514768')
     return "Hello GND! Example: <a href=%s>%s</a>" % (example, example)
 
 
+def create_app(warm=False, **settings):
+    """
+    Create the application. The databases are located via config.py or
+    the environment (GNDZERO_DB, GNDZERO_NAMES, ...), otherwise the outputs
+    of the pipeline tasks are used; `settings` override both. Records
+    downloaded on a cache miss go to a separate CACHE database, outside of
+    the pipeline outputs.
+
+    Without an explicit DB, the server follows the pipeline: it serves the
+    newest outputs and switches to new ones, once they are built (checked
+    every WATCH_SECONDS).
+
+    With `warm`, the most popular records are prefetched (see `warmup`)
+    before the app is returned. Nothing stays open, so the app can be
+    created and warmed once in the gunicorn master, before it starts
+    listening, and be shared by the forked workers:
+
+        $ gunicorn --preload --workers 4 --bind 127.0.0.1:5000 'server:create_app(warm=True)'
+    """
+    app = Flask(__name__)
+    fixed = bool(setting('DB') or settings.get('DB'))
+    app.config.update(dict((name, setting(name)) for name, _ in DATABASES),
+                      DB=setting('DB'))
+    app.config.update(WATCH_SECONDS=float(setting('WATCH_SECONDS',
+                                                  0 if fixed else 60)),
+                      CACHE=setting('CACHE', os.path.join(HOME, TAG,
+                                                          'server-cache.db')),
+                      RESPONSE_CACHE_BYTES=int(setting('RESPONSE_CACHE_BYTES',
+                                                       256 * 1024 * 1024)),
+                      WARMUP_RANKING=resolve('WARMUP_RANKING',
+                                             'TranslatePageRank', ext='tsv'),
+                      WARMUP_LOG=setting('WARMUP_LOG'),
+                      WARMUP_TOP=int(setting('WARMUP_TOP', 20000)),
+                      WARMUP_SECONDS=float(setting('WARMUP_SECONDS', 60)),
+                      BASE_URL=setting('BASE_URL'),
+                      PORT=int(setting('PORT', 7000)))
+    app.config.update(settings)
+    app.extensions['dataset'] = Dataset(app.config)
+    app.extensions['watcher.lock'] = threading.Lock()
+    app.register_blueprint(blueprint)
+    if warm:
+        warmup(app)
+    if hasattr(gc, 'freeze'):
+        # keep everything created so far out of the garbage collector, so
+        # that forked workers do not copy these pages (python 3.7+)
+        gc.freeze()
+    return app
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=7000, debug=True)
+    app = create_app(warm=True)
+    app.run(host="0.0.0.0", port=app.config['PORT'], debug=True)